@@ -1,17 +1,19 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 BagIt "Bag Diff" Generator
 by Stephen Eisenhauer
 last updated 2013-07-05
 
-Note: This script has only been developed and tested using bagit-python v1.2.1.
+Note: This script requires Python 3.
+
+This script has only been developed and tested using bagit-python v1.2.1.
 If things aren't working correctly, try grabbing that version of bagit-python
 and placing it in the same directory as this script (or installing it).
 
 This tool will generate what we call a "Bag Diff"; A new Change Bag encapsulating any modified or added files is the result. This Change Bag can be ingested into a repository alongside the previously ingested Bag to which the Change Bag might relate. This helps to avoid data duplication. A list of all added, modified, and deleted files is printed to the screen. Currently this information must be noted outside of the bag for referencing any deleted files at a later date for the purposes of cleanup. The script could be enhanced to include this information in the bag-info.txt file of the resulting Change Bag.
    
    Usage:
-        % python bag-diff.py -m /path/to/old/manifests/dir /path/to/bag
+        % python3 bag-diff.py -m /path/to/old/manifests/dir /path/to/bag
 
 The Change Bag will be created as /path/to/bag_changes0, or you can specify
 the path yourself using the -o argument.
@@ -22,6 +24,11 @@ import shutil
 import argparse
 import bagit
 import re
+import mmap
+import binascii
+import heapq
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Exit status codes
@@ -30,58 +37,384 @@ class Status:
     NO_CHANGES = 1
 
 
-def read_checksums(manifest_path):
+# Manifests larger than this (in bytes) are memory-mapped instead of read
+_MMAP_THRESHOLD = 1024 * 1024
+
+# Manifests larger than this (in bytes) are diffed without loading them
+_STREAMING_THRESHOLD = 64 * 1024 * 1024
+
+# Entries sorted in memory at a time when diffing manifests from disk,
+# and the most sorted runs merged at once
+_SORT_RUN_SIZE = 250000
+_MERGE_FAN_IN = 64
+
+# Relative strength of the checksum algorithms BagIt manifests commonly use
+_ALGO_STRENGTH = {
+    'md5': 1,
+    'sha1': 2,
+    'sha256': 3,
+    'sha512': 4,
+}
+
+# ASCII digits only; str.isdigit() also accepts characters int() rejects
+_DIGITS_RE = re.compile(r'[0-9]+')
+
+# [tag]manifest-<algo>.txt file names
+_MANIFEST_NAME_RE = re.compile(r'^([a-z]+)-([a-z0-9]+)\.txt$')
+_ANY_MANIFEST_RE = re.compile(r'^(tag)?manifest-([a-z0-9]+)\.txt$')
+
+# One manifest entry per line: a hash token, whitespace, then a non-blank
+# path (optionally prefixed with "*" for binary mode), with trailing
+# whitespace and any CR of a CRLF line ending dropped.
+_MANIFEST_RE = re.compile(
+    br'(?m)^[ \t]*([^ \t\r\n#][^ \t\r\n]*)[ \t]+\*?'
+    br'(?![ \t\r]*$)([^\r\n]+?)[ \t\r]*$')
+
+# A path that is absolute (POSIX or Windows style) or has a ".." component
+_UNSAFE_PATH_RE = re.compile(
+    br'^(?:[/\\]|[A-Za-z]:)|(?:^|[/\\])\.\.(?:[/\\]|$)')
+
+# Anything in a manifest that could be the start of such a path
+_SUSPECT_PATHS_RE = re.compile(br'\.\.|[ \t*](?:[/\\]|[A-Za-z]:)')
+
+
+def read_checksums(manifest_path, drop_cache=False):
     """
     An iterator that provides (path, hash) tuples from a BagIt manifest
-    (or tagmanifest) file.
+    (or tagmanifest) file. If drop_cache is true, the file is dropped from
+    the page cache afterwards, for manifests that won't be read again.
     """
     manifest_file = open(manifest_path, 'rb')
+    data = None
 
     try:
-        for line in manifest_file:
-            line = line.strip()
+        # Manifests are read front to back
+        _fadvise(manifest_file, 'POSIX_FADV_SEQUENTIAL')
 
-            # Ignore blank lines and comments.
-            if line == "" or line.startswith("#"): continue
+        # Large manifests are mapped rather than read, so the regex scans
+        # the page cache directly instead of a private copy of the file
+        if os.fstat(manifest_file.fileno()).st_size > _MMAP_THRESHOLD:
+            data = mmap.mmap(manifest_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+        else:
+            data = manifest_file.read()
 
-            entry = line.split(None, 1)
+        # BagIt manifest paths are already normalized, '/'-separated and
+        # relative to the bag, so they are used as-is. Only a manifest in
+        # which some path might be absolute or contain ".." needs its paths
+        # checked one by one.
+        check_paths = _SUSPECT_PATHS_RE.search(data) is not None
 
-            # Ignore lines not containing exactly 2 tokens
-            if len(entry) != 2: continue
+        # Blank lines, comments and lines without both a hash and a path are
+        # never matched by _MANIFEST_RE, so they are skipped implicitly.
+        for match in _MANIFEST_RE.finditer(data):
+            entry_hash = _decode_hash(match.group(1))
+            entry_path = match.group(2)
+            if check_paths and _UNSAFE_PATH_RE.search(entry_path):
+                raise ValueError("%s: path escapes the bag: %r"
+                                 % (manifest_path, entry_path))
+            # Interned so that the manifests for each algorithm share one
+            # copy of every path
+            entry_path = sys.intern(entry_path.decode('utf-8'))
 
-            entry_hash = entry[0]
-            entry_path = os.path.normpath(entry[1].lstrip("*"))
-            
             yield (entry_path, entry_hash)
     finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+        if drop_cache:
+            _fadvise(manifest_file, 'POSIX_FADV_DONTNEED')
         manifest_file.close()
 
 
-def load_manifests(manifests_dir):
+def _decode_hash(entry_hash):
+    """
+    Converts a hex checksum (bytes) from a manifest to the raw digest, which
+    takes half the memory and compares case-insensitively. Anything that
+    isn't valid hex is kept as text so it can still be compared.
+    """
+    try:
+        return binascii.unhexlify(entry_hash)
+    except (TypeError, ValueError):
+        return entry_hash.decode('utf-8')
+
+
+def _fadvise(f, advice):
+    """
+    Gives the kernel an access pattern hint (a POSIX_FADV_* name) for the
+    whole of file object f, where the platform supports it.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+
+
+def _match_files(dir_path, name_re):
+    """
+    Yields a (match, path) tuple for each regular file in dir_path whose
+    name matches name_re.
+    """
+    # DirEntry.is_file() is usually answered from the directory listing
+    # itself, so this avoids a stat per entry
+    with os.scandir(dir_path) as entries:
+        for dir_entry in entries:
+            match = name_re.match(dir_entry.name)
+            if match and dir_entry.is_file():
+                yield (match, dir_entry.path)
+
+
+def find_manifests(manifests_dir):
     """
-    Finds all [tag]manifest-*.txt files in manifests_dir and loads their
-    entries into a easy-to-navigate dict.
+    Finds all [tag]manifest-*.txt files in manifests_dir and returns their
+    paths in a easy-to-navigate dict ({manifest_type: {algo: path}}).
     """
-    checksums = {
+    manifests = {
         'payload': {},
         'tags': {}
     }
     
-    for f in os.listdir(manifests_dir):
-        match = re.match("^([a-z]+)-([a-z0-9]+)\.txt$", f)
-        f_abs = os.path.abspath(os.path.join(manifests_dir, f))
-        if os.path.isfile(f_abs) and match:
-            manifest_type = None
-            if match.group(1) == "manifest":
-                manifest_type = "payload"
-            elif match.group(1) == "tagmanifest":
-                manifest_type = "tags"
-            if manifest_type:
-                algo = match.group(2)
-                checksums[manifest_type][algo] = {}
-                for entry in read_checksums(f_abs):
-                    checksums[manifest_type][algo][entry[0]] = entry[1]
-    return checksums
+    for match, f_abs in _match_files(manifests_dir, _MANIFEST_NAME_RE):
+        manifest_type = None
+        if match.group(1) == "manifest":
+            manifest_type = "payload"
+        elif match.group(1) == "tagmanifest":
+            manifest_type = "tags"
+        if manifest_type:
+            algo = match.group(2)
+            manifests[manifest_type][algo] = f_abs
+    return manifests
+
+
+def _diff_checksums(old_entries, new_entries):
+    """
+    Compares two {path: hash} dicts, returning the sets of paths that were
+    (added, deleted, modified) going from old_entries to new_entries.
+    """
+    old_paths = old_entries.keys()
+    new_paths = new_entries.keys()
+    # Path is in bag but not in old manifests
+    added = new_paths - old_paths
+    # Path is in old manifests but not in current bag
+    deleted = old_paths - new_paths
+    # Checksum has changed for path
+    modified = set(path for path in old_paths & new_paths
+                   if old_entries[path] != new_entries[path])
+    return (added, deleted, modified)
+
+
+def diff_manifests(old_manifest, new_manifest):
+    """
+    Diffs two manifest files by loading both into memory. Returns the sets
+    of paths that were (added, deleted, modified).
+    """
+    # The old manifest isn't read again after this (the bag's own
+    # manifests are copied into the Change Bag afterwards)
+    old_entries = dict(read_checksums(old_manifest, drop_cache=True))
+    new_entries = dict(read_checksums(new_manifest))
+    return _diff_checksums(old_entries, new_entries)
+
+
+def _entry_path(entry):
+    """
+    Sort key for a (path, hash) manifest entry.
+    """
+    return entry[0]
+
+
+def _write_run(entries, tmp_dir):
+    """
+    Writes entries ((path, hash) tuples, already in path order) out as a
+    new manifest file in tmp_dir, returning the file's path.
+    """
+    fd, run_path = tempfile.mkstemp(suffix='.txt', dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as run_file:
+        for path, entry_hash in entries:
+            if isinstance(entry_hash, bytes):
+                entry_hash = binascii.hexlify(entry_hash)
+            else:
+                entry_hash = entry_hash.encode('utf-8')
+            # The "*" keeps any leading "*" or space in path from being
+            # taken as part of the separator when the run is read back
+            run_file.write(entry_hash + b' *' + path.encode('utf-8') + b'\n')
+    return run_path
+
+
+def _merge_runs(run_paths, tmp_dir):
+    """
+    Merges the sorted run files run_paths into one new run in tmp_dir,
+    removing the originals, and returns the new run's path.
+    """
+    merged = heapq.merge(*[read_checksums(run_path, drop_cache=True)
+                           for run_path in run_paths], key=_entry_path)
+    merged_path = _write_run(merged, tmp_dir)
+    for run_path in run_paths:
+        os.remove(run_path)
+    return merged_path
+
+
+def _sorted_checksums(manifest_path, tmp_dir, drop_cache=False):
+    """
+    Like read_checksums, but provides the entries in ascending path order,
+    keeping only the last entry for any path listed more than once.
+
+    Manifests can't be assumed to be sorted (bagit-python, for one, lists
+    a directory's files before its subdirectories), so they are sorted
+    externally: entries are read in runs of _SORT_RUN_SIZE, each run is
+    sorted and written to tmp_dir, and the runs are merged back together,
+    at most _MERGE_FAN_IN at a time.
+    """
+    runs = []
+    run = []
+    for entry in read_checksums(manifest_path, drop_cache):
+        run.append(entry)
+        if len(run) == _SORT_RUN_SIZE:
+            run.sort(key=_entry_path)
+            runs.append(_write_run(run, tmp_dir))
+            run = []
+    run.sort(key=_entry_path)
+
+    if not runs:
+        # Small enough to sort in memory
+        entries = iter(run)
+    else:
+        if run:
+            runs.append(_write_run(run, tmp_dir))
+            run = []
+        # Every run being merged holds an open file (and usually a
+        # mapping), so merge in passes until few enough are left
+        while len(runs) > _MERGE_FAN_IN:
+            runs = [_merge_runs(runs[i:i + _MERGE_FAN_IN], tmp_dir)
+                    for i in range(0, len(runs), _MERGE_FAN_IN)]
+        # merge() is stable, so repeated paths stay in manifest order
+        entries = heapq.merge(*[read_checksums(run_path, drop_cache=True)
+                                for run_path in runs], key=_entry_path)
+
+    last_entry = next(entries, None)
+    for entry in entries:
+        if entry[0] != last_entry[0]:
+            yield last_entry
+        last_entry = entry
+    if last_entry is not None:
+        yield last_entry
+
+
+def diff_manifests_streaming(old_manifest, new_manifest, tmp_dir=None):
+    """
+    Diffs two manifest files by walking them side by side in path order,
+    without loading either into memory. Returns the sets of paths that
+    were (added, deleted, modified).
+
+    Sorting the manifests needs scratch space about their size, taken from
+    a temporary directory inside tmp_dir. If tmp_dir is None the system
+    default is used, which on many systems is held in memory.
+    """
+    added = set()
+    deleted = set()
+    modified = set()
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        # As in diff_manifests, only the old manifest is done with after this
+        old_entries = _sorted_checksums(old_manifest, run_dir, drop_cache=True)
+        new_entries = _sorted_checksums(new_manifest, run_dir)
+        try:
+            old_entry = next(old_entries, None)
+            new_entry = next(new_entries, None)
+            while old_entry is not None and new_entry is not None:
+                if old_entry[0] < new_entry[0]:
+                    # Path is in old manifests but not in current bag
+                    deleted.add(old_entry[0])
+                    old_entry = next(old_entries, None)
+                elif old_entry[0] > new_entry[0]:
+                    # Path is in bag but not in old manifests
+                    added.add(new_entry[0])
+                    new_entry = next(new_entries, None)
+                else:
+                    # Checksum has changed for path
+                    if old_entry[1] != new_entry[1]:
+                        modified.add(old_entry[0])
+                    old_entry = next(old_entries, None)
+                    new_entry = next(new_entries, None)
+
+            # Whatever is left over exists on one side only
+            if old_entry is not None:
+                deleted.add(old_entry[0])
+                deleted.update(path for path, entry_hash in old_entries)
+            if new_entry is not None:
+                added.add(new_entry[0])
+                added.update(path for path, entry_hash in new_entries)
+        finally:
+            # Release the run files before their directory is removed
+            old_entries.close()
+            new_entries.close()
+
+    return (added, deleted, modified)
+
+
+def _sendfile(src_fd, dst_fd, count):
+    """
+    os.sendfile with the argument order of os.copy_file_range.
+    """
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+# In-kernel copy methods, in order of preference
+_KERNEL_COPIES = []
+if hasattr(os, 'copy_file_range'):
+    _KERNEL_COPIES.append(os.copy_file_range)
+if hasattr(os, 'sendfile'):
+    _KERNEL_COPIES.append(_sendfile)
+
+
+def _fast_copy(src, dst):
+    """
+    Copies the file src to the path dst along with its metadata, like
+    shutil.copy2, but lets the kernel move the data when it can.
+    """
+    with open(src, 'rb') as fsrc:
+        src_fd = fsrc.fileno()
+        size = os.fstat(src_fd).st_size
+        remaining = size
+
+        # Opening dst would truncate src if they were the same file
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            raise shutil.Error("%s and %s are the same file" % (src, dst))
+
+        with open(dst, 'wb') as fdst:
+            dst_fd = fdst.fileno()
+
+            for kernel_copy in _KERNEL_COPIES:
+                try:
+                    while remaining > 0:
+                        copied = kernel_copy(src_fd, dst_fd, remaining)
+                        if not copied:
+                            # Some kernels and filesystems return 0 rather
+                            # than failing when they can't copy; treat that
+                            # the same
+                            break
+                        remaining -= copied
+                except OSError:
+                    # Not supported between these files
+                    pass
+                if remaining == 0:
+                    break
+                # Both file offsets have advanced past whatever was copied,
+                # so the next method picks up where this one stopped
+            else:
+                shutil.copyfileobj(fsrc, fdst)
+
+            fdst.flush()
+            copied_size = os.fstat(dst_fd).st_size
+            if copied_size != size:
+                raise OSError("%s: copied %d of %d bytes to %s"
+                              % (src, copied_size, size, dst))
+
+    shutil.copystat(src, dst)
+
+
+def _algo_strength(algo):
+    """
+    Sort key ranking checksum algorithms from weakest to strongest.
+    Unrecognised algorithms rank lowest (ties are broken by name).
+    """
+    return (_ALGO_STRENGTH.get(algo, 0), algo)
 
 
 def make_bag_diff_from_manifests(bag_path, manifests_path, output_path, skip_verify=False):
@@ -91,76 +424,88 @@ def make_bag_diff_from_manifests(bag_path, manifests_path, output_path, skip_ver
     given as manifests_path.
     
     """
-    # Load Manifests dir's manifest(s) into a data structure
-    manifests_checksums = load_manifests(manifests_path)
-    
-    if len(manifests_checksums['tags']) == 0:
-        print "WARNING: No tagmanifest files found in manifests directory. Tag files cannot be included in this diff."
+    # Find the Manifests dir's manifest(s)
+    manifests = find_manifests(manifests_path)
     
-    # Load Bag's manifests into a data structure
-    bag_checksums = load_manifests(bag_path)
+    if len(manifests['tags']) == 0:
+        print("WARNING: No tagmanifest files found in manifests directory. Tag files cannot be included in this diff.")
     
-    # Prune any sections from each structure that don't exist in the other
-    for m_type in manifests_checksums:
-        for algo in manifests_checksums[m_type]:
-            if not algo in bag_checksums[m_type]:
-                del manifests_checksums[m_type][algo]
-    for m_type in bag_checksums:
-        for algo in bag_checksums[m_type]:
-            if not algo in manifests_checksums[m_type]:
-                del bag_checksums[m_type][algo]
+    # Find the Bag's manifests
+    bag_manifests = find_manifests(bag_path)
     
-    # At this point, the two structures should be "balanced" enough for 
-    # easy comparison (neither one contains entries from a kind of
-    # manifest that the other one lacks)
+    # Only algorithms with a manifest on both sides can be compared; any
+    # other manifests are ignored
+    common_algos = {}
+    for m_type in manifests:
+        common_algos[m_type] = set(manifests[m_type]) & set(bag_manifests[m_type])
     
-    # Iterate and compare checksums to find modifications/deletions
+    # Compare checksums to find additions/modifications/deletions
     added = set()
     deleted = set()
     modified = set()
-    for m_type in manifests_checksums:
-        for algo in manifests_checksums[m_type]:
-            for path in manifests_checksums[m_type][algo]:
-                if not path in bag_checksums[m_type][algo]:
-                    deleted.add(path) # Path is in old manifests but not in current bag
-                elif manifests_checksums[m_type][algo][path] != bag_checksums[m_type][algo][path]:
-                    modified.add(path) # Checksum has changed for path
+    for m_type in common_algos:
+        if not common_algos[m_type]:
+            continue
+        # Every manifest covers the same files, so a single algorithm is
+        # enough to find the changes; use the strongest one available
+        algo = max(common_algos[m_type], key=_algo_strength)
+        old_manifest = manifests[m_type][algo]
+        new_manifest = bag_manifests[m_type][algo]
+        
+        # Huge manifests are diffed straight from disk rather than loaded,
+        # sorting them beside the output rather than in the (often
+        # memory-backed) system temporary directory
+        if max(os.path.getsize(old_manifest),
+               os.path.getsize(new_manifest)) > _STREAMING_THRESHOLD:
+            changes = diff_manifests_streaming(
+                old_manifest, new_manifest,
+                os.path.dirname(os.path.abspath(output_path)))
+        else:
+            changes = diff_manifests(old_manifest, new_manifest)
+        added |= changes[0]
+        deleted |= changes[1]
+        modified |= changes[2]
     
-    # Now compare in reverse to find additions
-    for m_type in bag_checksums:
-        for algo in bag_checksums[m_type]:
-            for path in bag_checksums[m_type][algo]:
-                if not path in manifests_checksums[m_type][algo]:
-                    added.add(path) # Path is in bag but not in old manifests
-    
-    print "Added:"
-    print added
-    print "Deleted:"
-    print deleted
-    print "Modified:"
-    print modified
+    print("Added:")
+    print(added)
+    print("Deleted:")
+    print(deleted)
+    print("Modified:")
+    print(modified)
     
     # If all of these lists are empty, abort
     if (len(modified) + len(added) + len(deleted)) == 0:
-        print "Nothing to do; No changes were detected."
+        print("Nothing to do; No changes were detected.")
         return Status.NO_CHANGES
     
     # Create directory for the bag diff
     os.makedirs(output_path)
     
     # Copy the manifests themselves into the bag diff for safekeeping
-    for f in os.listdir(bag_path):
-        if os.path.isfile(os.path.join(bag_path, f)) and \
-        re.match("^(tag)?manifest-([a-z0-9]+)\.txt$", f):
-            shutil.copy2(os.path.join(bag_path, f), output_path)
+    for match, f_abs in _match_files(bag_path, _ANY_MANIFEST_RE):
+        shutil.copy2(f_abs, output_path)
 
     # Load output directory with modified and added files
-    added_and_modified = added.union(modified)
-    for path in added_and_modified:
-        dest = os.path.join(output_path, os.path.dirname(path))
-        if not os.path.isdir(dest):
-            os.makedirs(dest)
-        shutil.copy2(os.path.join(bag_path, path), dest)
+    # (in path order, so files in the same directory are read back-to-back)
+    added_and_modified = sorted(added | modified)
+    # Create each destination directory once, rather than checking for it
+    # before every file. Deepest directories go first; makedirs creates
+    # their parents along the way, so those are remembered and skipped.
+    dest_dirs = set(os.path.dirname(path) for path in added_and_modified)
+    created_dirs = set([''])  # output_path itself
+    for dest_dir in sorted(dest_dirs, reverse=True):
+        if dest_dir in created_dirs:
+            continue
+        os.makedirs(os.path.join(output_path, dest_dir), exist_ok=True)
+        while dest_dir not in created_dirs:
+            created_dirs.add(dest_dir)
+            dest_dir = os.path.dirname(dest_dir)
+    # The copies are independent and I/O bound, so run several at once
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        sources = [os.path.join(bag_path, path) for path in added_and_modified]
+        dests = [os.path.join(output_path, path) for path in added_and_modified]
+        # Consume the results so any copy error is raised here
+        list(executor.map(_fast_copy, sources, dests))
     
     # Prepare metadata for new Bag Diff
     # This should likely inherit contact info and identifier info from the 
@@ -204,14 +549,18 @@ if __name__ == "__main__":
     # Determine the diff output directory to use
     output_path = args.output_dir
     if not output_path:
-        change_num = 0
-        while True:
-            output_path = "%s_changes%d" % (bag_path, change_num)
-            if os.path.isdir(output_path):  # if dir already exists
-                change_num += 1             # try next number
-            else:
-                break
-    print "Using output path: " + output_path
+        # Use the number after the highest existing <bag>_changesN sibling
+        prefix = os.path.basename(bag_path) + "_changes"
+        change_nums = [-1]
+        with os.scandir(os.path.dirname(bag_path)) as entries:
+            for dir_entry in entries:
+                suffix = dir_entry.name[len(prefix):]
+                if dir_entry.name.startswith(prefix) and _DIGITS_RE.fullmatch(suffix) \
+                and dir_entry.is_dir():
+                    change_nums.append(int(suffix))
+        change_num = max(change_nums) + 1
+        output_path = f"{bag_path}_changes{change_num}"
+    print(f"Using output path: {output_path}")
 
     # Call the appropriate operation
     if manifests_path: